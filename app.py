@@ -1,6 +1,6 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers.kms_router import kms_router
+from routers.kms_router import kms_router, close_bundle_packer
 from routers.aes_router import aes_router
 
 import logging
@@ -44,6 +44,11 @@ async def startup_event():
 ==========================================
 """)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Escribe los archivos pequeños que sigan en el buffer de empaquetado
+    close_bundle_packer()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("app:app", host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -25,4 +25,13 @@ AWS_CONFIG = {
 ENCRYPTION_PASSWORD = get_required_env('ENCRYPTION_PASSWORD', 'para encriptación AES')
 
 # Configuración específica KMS
-KMS_KEY_ID = get_required_env('KMS_KEY_ID', 'para encriptación KMS')
\ No newline at end of file
+KMS_KEY_ID = get_required_env('KMS_KEY_ID', 'para encriptación KMS')
+
+# Empaquetado opcional de objetos pequeños en bundles KMS
+KMS_PACKING_CONFIG = {
+    "enabled": os.getenv("KMS_PACKING_ENABLED", "false").lower() in ("1", "true", "yes"),
+    "prefix": os.getenv("KMS_PACKING_PREFIX", "_bundles/"),
+    "max_object_size": int(os.getenv("KMS_PACKING_MAX_OBJECT_SIZE", str(128 * 1024))),
+    "max_bundle_size": int(os.getenv("KMS_PACKING_MAX_BUNDLE_SIZE", str(8 * 1024 * 1024))),
+    "flush_interval": float(os.getenv("KMS_PACKING_FLUSH_INTERVAL", "0.2"))
+}
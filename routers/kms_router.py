@@ -1,20 +1,29 @@
 from fastapi import APIRouter, Depends, File, UploadFile, Form, Query, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any, List
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
+import asyncio
 import logging
-from config import AWS_CONFIG, KMS_KEY_ID
+import threading
+from config import AWS_CONFIG, KMS_KEY_ID, KMS_PACKING_CONFIG
 from utils.s3_kms_uploader import S3KMSUploader
+from utils.s3_bundle_packer import S3BundlePacker, BundleEntryNotFound
 
 kms_router = APIRouter(tags=["KMS Encryption"])
 logger = logging.getLogger(__name__)
 
+bundle_packer = None
+bundle_packer_lock = threading.Lock()
+
 class UploadResponse(BaseModel):
     success: bool
     message: str
     s3_key: Optional[str] = None
     file_size: Optional[int] = None
+    bundle_key: Optional[str] = None
 
 class MultipleUploadResponse(BaseModel):
     results: List[UploadResponse]
@@ -32,6 +41,28 @@ class S3ObjectList(BaseModel):
     total_count: int
     prefix: Optional[str] = None
 
+class PackedObject(BaseModel):
+    key: str
+    size: int
+    bundle_key: str
+    content_type: str
+
+class PackedObjectList(BaseModel):
+    objects: List[PackedObject]
+    total_count: int
+    prefix: Optional[str] = None
+
+class DeleteResponse(BaseModel):
+    success: bool
+    message: str
+    s3_key: str
+
+class CompactionResponse(BaseModel):
+    bundles_compacted: int
+    bundles_removed: int
+    bytes_reclaimed: int
+    tombstones_removed: int
+
 def get_kms_uploader():
     try:
         # Validar que todas las configuraciones requeridas están presentes
@@ -85,13 +116,34 @@ def get_kms_uploader():
         logger.error(f"Uploader init failed: {e}")
         raise HTTPException(500, f"S3 uploader initialization failed: {str(e)}")
 
+def get_bundle_packer():
+    global bundle_packer
+    if not KMS_PACKING_CONFIG['enabled']:
+        raise HTTPException(404, "Packing mode is disabled")
+    if bundle_packer is None:
+        # Se llama desde el threadpool: el lock evita crear varios packers con buffers huerfanos
+        with bundle_packer_lock:
+            if bundle_packer is None:
+                # Un unico packer por proceso para que el buffer agrupe las subidas de todas las peticiones
+                bundle_packer = S3BundlePacker(
+                    get_kms_uploader(),
+                    prefix=KMS_PACKING_CONFIG['prefix'],
+                    max_object_size=KMS_PACKING_CONFIG['max_object_size'],
+                    max_bundle_size=KMS_PACKING_CONFIG['max_bundle_size'],
+                    flush_interval=KMS_PACKING_CONFIG['flush_interval']
+                )
+    return bundle_packer
+
+def close_bundle_packer():
+    if bundle_packer is not None:
+        bundle_packer.close()
+
 @kms_router.post("/upload", response_model=UploadResponse)
 async def upload_file(
     file: UploadFile = File(...),
     s3_key: Optional[str] = Form(None),
     metadata_key: Optional[str] = Form(None),
-    metadata_value: Optional[str] = Form(None),
-    uploader: S3KMSUploader = Depends(get_kms_uploader)
+    metadata_value: Optional[str] = Form(None)
 ):
     try:
         content = await file.read()
@@ -99,13 +151,37 @@ async def upload_file(
             unique_id = str(uuid.uuid4())[:8]
             s3_key = f"{unique_id}_{file.filename}"
         
-        content_type = uploader._get_content_type(file.filename)
         metadata = {'original_filename': file.filename}
         
         if metadata_key and metadata_value:
             metadata[metadata_key] = metadata_value
         
-        success = uploader.upload_file_from_memory(
+        packer = None
+        if KMS_PACKING_CONFIG['enabled']:
+            packer = await run_in_threadpool(get_bundle_packer)
+            # El prefijo de bundles es interno; un objeto ajeno ahi no es un bundle valido
+            if s3_key.startswith(packer.prefix):
+                raise HTTPException(400, f"Keys under '{packer.prefix}' are reserved for packed bundles")
+        
+        # Los archivos pequeños se agrupan en un bundle para ahorrar PUTs y llamadas a KMS;
+        # usan el uploader del packer para no crear sesion ni hacer head_bucket por peticion
+        if packer is not None and packer.accepts(len(content)):
+            content_type = packer.uploader._get_content_type(file.filename)
+            bundle_key = await asyncio.wrap_future(
+                packer.add(s3_key, content, content_type, metadata)
+            )
+            return UploadResponse(
+                success=True,
+                message="File packed and uploaded successfully",
+                s3_key=s3_key,
+                file_size=len(content),
+                bundle_key=bundle_key
+            )
+        
+        uploader = await run_in_threadpool(get_kms_uploader)
+        content_type = uploader._get_content_type(file.filename)
+        success = await run_in_threadpool(
+            uploader.upload_file_from_memory,
             content,
             s3_key,
             content_type,
@@ -113,6 +189,13 @@ async def upload_file(
         )
         
         if success:
+            # Una copia empaquetada anterior de la misma clave quedaria obsoleta; solo se
+            # consulta el catalogo local para no listar S3 en cada subida grande
+            if packer is not None:
+                try:
+                    await run_in_threadpool(packer.delete, s3_key, False)
+                except Exception as e:
+                    logger.error(f"Packed copy cleanup error ({s3_key}): {e}")
             return UploadResponse(
                 success=True,
                 message="File uploaded successfully",
@@ -120,6 +203,9 @@ async def upload_file(
                 file_size=len(content)
             )
         raise HTTPException(500, "Upload failed")
+    except HTTPException:
+        # Re-lanzar HTTPException tal como está
+        raise
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(500, f"Upload failed: {str(e)}")
@@ -130,14 +216,37 @@ async def list_objects(
     uploader: S3KMSUploader = Depends(get_kms_uploader)
 ):
     try:
-        objects = uploader.list_objects(prefix)
-        return S3ObjectList(
-            objects=[S3Object(
+        objects = await run_in_threadpool(uploader.list_objects, prefix)
+        results = {
+            obj['Key']: S3Object(
                 key=obj['Key'],
                 size=obj['Size'],
                 last_modified=obj['LastModified'],
                 etag=obj['ETag']
-            ) for obj in objects],
+            ) for obj in objects
+        }
+        
+        # En modo empaquetado se ocultan los bundles internos y se muestran los archivos que contienen
+        if KMS_PACKING_CONFIG['enabled']:
+            packer = await run_in_threadpool(get_bundle_packer)
+            results = {
+                key: obj for key, obj in results.items()
+                if not key.startswith(packer.prefix)
+            }
+            for entry in await run_in_threadpool(packer.list_entries, prefix):
+                packed = S3Object(
+                    key=entry['key'],
+                    size=entry['length'],
+                    last_modified=datetime.fromtimestamp(entry['written_at'] / 1000, tz=timezone.utc),
+                    etag=entry['sha256']
+                )
+                current = results.get(entry['key'])
+                if current is None or current.last_modified < packed.last_modified:
+                    results[entry['key']] = packed
+        
+        objects = [results[key] for key in sorted(results)]
+        return S3ObjectList(
+            objects=objects,
             total_count=len(objects),
             prefix=prefix or None
         )
@@ -145,6 +254,80 @@ async def list_objects(
         logger.error(f"List error: {e}")
         raise HTTPException(500, f"List failed: {str(e)}")
 
+@kms_router.get("/packed/objects", response_model=PackedObjectList)
+async def list_packed_objects(
+    prefix: str = Query(""),
+    packer: S3BundlePacker = Depends(get_bundle_packer)
+):
+    try:
+        entries = await run_in_threadpool(packer.list_entries, prefix)
+        return PackedObjectList(
+            objects=[PackedObject(
+                key=entry['key'],
+                size=entry['length'],
+                bundle_key=entry['bundle_key'],
+                content_type=entry['content_type']
+            ) for entry in entries],
+            total_count=len(entries),
+            prefix=prefix or None
+        )
+    except Exception as e:
+        logger.error(f"Packed list error: {e}")
+        raise HTTPException(500, f"List failed: {str(e)}")
+
+@kms_router.get("/packed/download/{s3_key:path}")
+async def download_packed_object(
+    s3_key: str,
+    packer: S3BundlePacker = Depends(get_bundle_packer)
+):
+    try:
+        content, entry = await run_in_threadpool(packer.get, s3_key)
+    except BundleEntryNotFound:
+        raise HTTPException(404, f"Packed object not found: {s3_key}")
+    except Exception as e:
+        logger.error(f"Packed download error: {e}")
+        raise HTTPException(500, f"Download failed: {str(e)}")
+    
+    filename = entry['metadata'].get('original_filename', s3_key.rsplit('/', 1)[-1])
+    return Response(
+        content=content,
+        media_type=entry['content_type'],
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"'
+        }
+    )
+
+@kms_router.delete("/packed/{s3_key:path}", response_model=DeleteResponse)
+async def delete_packed_object(
+    s3_key: str,
+    packer: S3BundlePacker = Depends(get_bundle_packer)
+):
+    try:
+        deleted = await run_in_threadpool(packer.delete, s3_key)
+    except Exception as e:
+        logger.error(f"Packed delete error: {e}")
+        raise HTTPException(500, f"Delete failed: {str(e)}")
+    
+    if not deleted:
+        raise HTTPException(404, f"Packed object not found: {s3_key}")
+    return DeleteResponse(
+        success=True,
+        message="File deleted successfully",
+        s3_key=s3_key
+    )
+
+@kms_router.post("/packed/compact", response_model=CompactionResponse)
+async def compact_bundles(
+    min_live_ratio: float = Query(0.5, ge=0.0, le=1.0),
+    packer: S3BundlePacker = Depends(get_bundle_packer)
+):
+    try:
+        stats = await run_in_threadpool(packer.compact, min_live_ratio)
+        return CompactionResponse(**stats)
+    except Exception as e:
+        logger.error(f"Compaction error: {e}")
+        raise HTTPException(500, f"Compaction failed: {str(e)}")
+
 # Endpoint para verificar la configuración (útil para debugging)
 @kms_router.get("/health")
 async def health_check():
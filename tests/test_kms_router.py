@@ -0,0 +1,126 @@
+import os
+import time
+import importlib
+import threading
+import unittest
+from unittest import mock
+
+for _key in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'S3_BUCKET_NAME',
+             'KMS_KEY_ID', 'ENCRYPTION_PASSWORD'):
+    os.environ.setdefault(_key, 'test')
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from utils.s3_bundle_packer import S3BundlePacker
+from tests.test_s3_bundle_packer import FakeS3Client, FakeUploader
+
+kms = importlib.import_module('routers.kms_router')
+get_kms_uploader = kms.get_kms_uploader
+
+
+class KMSRouterPackingTest(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        self.uploader = FakeUploader(self.s3)
+        self.packer = S3BundlePacker(self.uploader, max_object_size=10,
+                                     flush_interval=0.01, refresh_interval=0)
+
+        patches = [
+            mock.patch.dict(kms.KMS_PACKING_CONFIG, {'enabled': True}),
+            mock.patch.object(kms, 'bundle_packer', self.packer),
+            mock.patch.object(kms, 'get_kms_uploader', return_value=self.uploader),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        app = FastAPI()
+        app.include_router(kms.kms_router, prefix="/kms")
+        app.dependency_overrides[get_kms_uploader] = lambda: self.uploader
+        self.client = TestClient(app)
+
+    def upload(self, s3_key, content):
+        return self.client.post(
+            '/kms/upload',
+            files={'file': ('file.txt', content)},
+            data={'s3_key': s3_key}
+        )
+
+    def listed_keys(self):
+        return [obj['key'] for obj in self.client.get('/kms/objects').json()['objects']]
+
+    def test_small_upload_is_packed(self):
+        response = self.upload('a', b'small')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['bundle_key'].startswith('_bundles/'))
+        self.assertNotIn('a', self.s3.objects)
+        self.assertEqual(self.client.get('/kms/packed/download/a').content, b'small')
+
+    def test_large_upload_bypasses_packer_and_replaces_packed_copy(self):
+        self.upload('a', b'small')
+
+        response = self.upload('a', b'x' * 50)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['bundle_key'])
+        self.assertEqual(self.s3.objects['a'], b'x' * 50)
+        self.assertEqual(self.client.get('/kms/packed/download/a').status_code, 404)
+
+    def test_large_upload_succeeds_when_tombstone_fails(self):
+        self.upload('a', b'small')
+
+        with mock.patch.object(self.packer, 'delete', side_effect=RuntimeError('boom')):
+            response = self.upload('a', b'x' * 50)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_upload_into_bundle_prefix_is_rejected(self):
+        response = self.upload('_bundles/x.bundle', b'x' * 50)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.s3.objects, {})
+
+    def test_listing_hides_bundles_and_merges_packed_entries(self):
+        self.upload('packed', b'small')
+        self.upload('plain', b'x' * 50)
+
+        self.assertEqual(self.listed_keys(), ['packed', 'plain'])
+
+    def test_delete_and_compact_endpoints(self):
+        self.upload('a', b'small')
+
+        response = self.client.delete('/kms/packed/a')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.delete('/kms/packed/a').status_code, 404)
+
+        stats = self.client.post('/kms/packed/compact').json()
+        self.assertEqual(stats['bundles_removed'], 1)
+        self.assertEqual(self.listed_keys(), [])
+
+    def test_packer_singleton_is_created_once(self):
+        def slow_uploader():
+            time.sleep(0.05)
+            return self.uploader
+
+        results = []
+        with mock.patch.object(kms, 'bundle_packer', None), \
+             mock.patch.object(kms, 'get_kms_uploader', side_effect=slow_uploader) as factory:
+            threads = [threading.Thread(target=lambda: results.append(kms.get_bundle_packer()))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(factory.call_count, 1)
+        self.assertEqual(len({id(packer) for packer in results}), 1)
+
+    def test_packed_endpoints_disabled(self):
+        with mock.patch.dict(kms.KMS_PACKING_CONFIG, {'enabled': False}):
+            self.assertEqual(self.client.get('/kms/packed/objects').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import io
+import threading
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from utils import s3_bundle_packer
+from utils.s3_bundle_packer import S3BundlePacker, BundleEntryNotFound
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.get_calls = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.get_calls.append((Key, Range))
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body = self.objects[Key]
+        if Range:
+            spec = Range[len('bytes='):]
+            if spec.startswith('-'):
+                length = int(spec[1:])
+                if length == 0 or not body:
+                    raise ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+                body = body[-length:]
+            else:
+                start, end = (int(v) for v in spec.split('-'))
+                # Como S3: un rango sintacticamente invalido se ignora y se devuelve el objeto completo
+                if start <= end:
+                    if start >= len(body):
+                        raise ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+                    body = body[start:end + 1]
+        return {'Body': io.BytesIO(body)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                keys = sorted(k for k in client.objects if k.startswith(Prefix))
+                return [{'Contents': [{'Key': k} for k in keys]}]
+
+        return Paginator()
+
+
+class FakeUploader:
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.bucket_name = 'test-bucket'
+        self.fail = False
+        self.gate = None
+
+    def upload_file_from_memory(self, file_content, s3_key, content_type='application/octet-stream',
+                                metadata=None, bucket_key_enabled=False):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.fail:
+            return False
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=s3_key, Body=file_content)
+        return True
+
+    def list_objects(self, prefix=''):
+        return [
+            {'Key': key, 'Size': len(body), 'LastModified': datetime.now(timezone.utc), 'ETag': 'etag'}
+            for key, body in sorted(self.s3_client.objects.items()) if key.startswith(prefix)
+        ]
+
+    def _get_content_type(self, filename):
+        return 'text/plain'
+
+
+class S3BundlePackerTest(unittest.TestCase):
+    def setUp(self):
+        self.s3 = FakeS3Client()
+        self.uploader = FakeUploader(self.s3)
+        self.packer = self.new_packer()
+
+    def new_packer(self):
+        return S3BundlePacker(self.uploader, flush_interval=60, refresh_interval=0)
+
+    def put(self, packer, key, data):
+        future = packer.add(key, data)
+        packer.flush()
+        return future.result(5)
+
+    def bundle_keys(self):
+        return sorted(k for k in self.s3.objects if k.endswith('.bundle'))
+
+    def tombstone_keys(self):
+        return sorted(k for k in self.s3.objects if '/tombstones/' in k)
+
+    def test_bundle_round_trip(self):
+        entries = [
+            {'key': f'file-{i}', 'data': bytes([i]) * (i + 1), 'content_type': 'text/plain',
+             'metadata': {'n': str(i)}, 'written_at': 1}
+            for i in range(5)
+        ]
+        written = self.packer._write_bundle('_bundles/0000000000001-a.bundle', entries)
+        index = self.packer._read_index('_bundles/0000000000001-a.bundle')
+
+        self.assertEqual(index, written)
+        self.assertEqual(index['file-3']['length'], 4)
+        self.assertEqual(index['file-3']['metadata'], {'n': '3'})
+        self.assertEqual(len(self.s3.get_calls), 1)
+
+    def test_index_larger_than_tail_read(self):
+        entries = [
+            {'key': f'file-{i}', 'data': b'x', 'content_type': 'text/plain',
+             'metadata': {}, 'written_at': 1}
+            for i in range(20)
+        ]
+        written = self.packer._write_bundle('_bundles/0000000000001-a.bundle', entries)
+        with mock.patch.object(s3_bundle_packer, 'INDEX_TAIL_READ', 64):
+            index = self.packer._read_index('_bundles/0000000000001-a.bundle')
+
+        self.assertEqual(index, written)
+        self.assertEqual(len(self.s3.get_calls), 2)
+
+    def test_ranged_read(self):
+        self.packer.add('a', b'first')
+        self.packer.add('b', b'second')
+        bundle_key = self.packer.flush()
+
+        data, entry = self.packer.get('b')
+
+        self.assertEqual(data, b'second')
+        self.assertEqual(self.s3.get_calls[-1], (bundle_key, 'bytes=5-10'))
+
+    def test_empty_object(self):
+        self.packer.add('a', b'first')
+        self.packer.add('empty', b'')
+        self.packer.flush()
+
+        self.assertEqual(self.packer.get('empty')[0], b'')
+        self.assertEqual(self.new_packer().get('empty')[0], b'')
+
+    def test_compact_removes_bundle_with_only_deleted_empty_objects(self):
+        self.put(self.packer, 'empty', b'')
+        self.packer.delete('empty')
+
+        stats = self.packer.compact()
+
+        self.assertEqual(stats['bundles_removed'], 1)
+        self.assertEqual(stats['tombstones_removed'], 1)
+        self.assertEqual(self.s3.objects, {})
+
+    def test_foreign_objects_under_prefix_are_skipped(self):
+        self.put(self.packer, 'a', b'data')
+        self.s3.objects['_bundles/report.bundle'] = b'z' * 100
+        self.s3.objects['_bundles/short.bundle'] = b'z'
+        self.s3.objects['_bundles/tombstones/notes.txt'] = b''
+
+        self.assertEqual([e['key'] for e in self.packer.list_entries()], ['a'])
+        self.assertEqual(self.new_packer().get('a')[0], b'data')
+
+    def test_local_delete_does_not_list_prefix(self):
+        self.put(self.packer, 'a', b'data')
+        other = self.new_packer()
+
+        with mock.patch.object(self.s3, 'get_paginator') as get_paginator:
+            self.assertFalse(other.delete('a', refresh=False))
+            self.assertTrue(self.packer.delete('a', refresh=False))
+
+        get_paginator.assert_not_called()
+
+    def test_pending_entry_is_readable_before_flush(self):
+        self.packer.add('a', b'buffered')
+
+        data, _ = self.packer.get('a')
+
+        self.assertEqual(data, b'buffered')
+        self.assertEqual(self.s3.objects, {})
+
+    def test_delete_then_compact_does_not_resurrect_older_copy(self):
+        self.packer.add('x', b'old')
+        self.packer.add('big', b'b' * 1000)
+        self.packer.flush()
+        self.put(self.packer, 'x', b'new')
+
+        self.assertTrue(self.packer.delete('x'))
+        self.packer.compact(0.9)
+
+        self.assertNotIn('x', [e['key'] for e in self.packer.list_entries()])
+        self.assertRaises(BundleEntryNotFound, self.packer.get, 'x')
+        self.assertRaises(BundleEntryNotFound, self.new_packer().get, 'x')
+
+    def test_compact_reclaims_deleted_entries_and_tombstones(self):
+        for i in range(4):
+            self.packer.add(f'f{i}', bytes([i]) * 100)
+        self.packer.flush()
+        for i in range(3):
+            self.packer.delete(f'f{i}')
+
+        stats = self.packer.compact()
+
+        self.assertEqual(stats['bundles_compacted'], 1)
+        self.assertEqual(stats['bytes_reclaimed'], 300)
+        self.assertEqual(stats['tombstones_removed'], 3)
+        self.assertEqual(self.tombstone_keys(), [])
+        self.assertEqual(self.new_packer().get('f3')[0], bytes([3]) * 100)
+
+    def test_compact_removes_bundle_without_live_entries(self):
+        self.put(self.packer, 'a', b'data')
+        self.packer.delete('a')
+
+        stats = self.packer.compact()
+
+        self.assertEqual(stats['bundles_removed'], 1)
+        self.assertEqual(self.s3.objects, {})
+
+    def test_reader_refreshes_after_compaction_by_other_instance(self):
+        self.packer.add('keep', b'k' * 10)
+        self.packer.add('drop', b'd' * 100)
+        self.packer.flush()
+        reader = self.new_packer()
+        self.assertEqual(reader.get('keep')[0], b'k' * 10)
+        old_bundle = self.bundle_keys()
+
+        self.packer.delete('drop')
+        self.packer.compact()
+
+        self.assertNotEqual(self.bundle_keys(), old_bundle)
+        self.assertEqual(reader.get('keep')[0], b'k' * 10)
+
+    def test_delete_from_stale_instance_after_compaction(self):
+        self.packer.add('keep', b'k' * 10)
+        self.packer.add('drop', b'd' * 100)
+        self.packer.add('x', b'x' * 10)
+        self.packer.flush()
+        other = self.new_packer()
+        other.list_entries()
+
+        self.packer.delete('drop')
+        self.packer.compact()
+        self.assertTrue(other.delete('x'))
+
+        self.assertNotIn('x', [e['key'] for e in other.list_entries()])
+        self.assertNotIn('x', [e['key'] for e in self.packer.list_entries()])
+        self.packer.compact(1.0)
+        self.assertEqual(self.tombstone_keys(), [])
+        self.assertEqual([e['key'] for e in self.new_packer().list_entries()], ['keep'])
+
+    def test_upload_after_delete_is_visible(self):
+        self.put(self.packer, 'a', b'one')
+        self.packer.delete('a')
+        self.put(self.packer, 'a', b'two')
+
+        self.assertEqual(self.packer.get('a')[0], b'two')
+        self.assertEqual(self.new_packer().get('a')[0], b'two')
+
+    def test_flush_failure_reaches_futures(self):
+        self.uploader.fail = True
+        futures = [self.packer.add(f'f{i}', b'data') for i in range(3)]
+
+        self.assertIsNone(self.packer.flush())
+
+        for future in futures:
+            self.assertRaises(RuntimeError, future.result, 5)
+        self.assertRaises(BundleEntryNotFound, self.packer.get, 'f0')
+
+    def test_delete_waits_for_flush_in_progress(self):
+        self.uploader.gate = threading.Event()
+        future = self.packer.add('a', b'data')
+        flusher = threading.Thread(target=self.packer.flush)
+        flusher.start()
+
+        result = {}
+        deleter = threading.Thread(target=lambda: result.setdefault('deleted', self.packer.delete('a')))
+        deleter.start()
+        self.uploader.gate.set()
+        flusher.join(5)
+        deleter.join(5)
+
+        self.assertIsNotNone(future.result(5))
+        self.assertTrue(result['deleted'])
+        self.assertRaises(BundleEntryNotFound, self.packer.get, 'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 from .aes_encryptor import AES256FileEncryptor
 from .s3_kms_uploader import S3KMSUploader
+from .s3_bundle_packer import S3BundlePacker, BundleEntryNotFound
 
-__all__ = ["AES256FileEncryptor", "S3KMSUploader"]
\ No newline at end of file
+__all__ = ["AES256FileEncryptor", "S3KMSUploader", "S3BundlePacker", "BundleEntryNotFound"]
@@ -0,0 +1,492 @@
+import json
+import time
+import uuid
+import struct
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Optional, Dict, Any, List, Tuple
+from botocore.exceptions import ClientError
+
+from .s3_kms_uploader import S3KMSUploader
+
+logger = logging.getLogger(__name__)
+
+# Formato del bundle: [datos concatenados][indice JSON][MAGIC (8 bytes)][longitud del indice (8 bytes)]
+BUNDLE_MAGIC = b'S3BNDL01'
+FOOTER_SIZE = len(BUNDLE_MAGIC) + 8
+BUNDLE_SUFFIX = '.bundle'
+TOMBSTONE_DIR = 'tombstones/'
+# Lectura especulativa del final del bundle: normalmente trae footer e indice en un solo GET
+INDEX_TAIL_READ = 64 * 1024
+
+
+class BundleEntryNotFound(KeyError):
+    pass
+
+
+class S3BundlePacker:
+    def __init__(self,
+                 uploader: S3KMSUploader,
+                 prefix: str = '_bundles/',
+                 max_object_size: int = 128 * 1024,
+                 max_bundle_size: int = 8 * 1024 * 1024,
+                 flush_interval: float = 0.2,
+                 refresh_interval: float = 1.0):
+        self.uploader = uploader
+        self.s3_client = uploader.s3_client
+        self.bucket_name = uploader.bucket_name
+        self.prefix = prefix
+        self.max_object_size = max_object_size
+        self.max_bundle_size = max_bundle_size
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._pending: List[Dict[str, Any]] = []
+        self._pending_bytes = 0
+        # key -> ultima subida aun no escrita en S3 (en el buffer o en un flush en curso)
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+
+        # bundle_key -> {key: entry} con todas las entradas del indice de cada bundle
+        self._bundles: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # key -> instantes de borrado; cada tombstone oculta las copias escritas hasta ese instante
+        self._tombstones: Dict[str, set] = {}
+        # key -> entrada viva mas reciente
+        self._catalog: Dict[str, Dict[str, Any]] = {}
+        # Objetos con sufijo .bundle que no tienen formato de bundle; no se vuelven a leer
+        self._invalid_bundles: set = set()
+        self._last_refresh = 0.0
+
+    def accepts(self, size: int) -> bool:
+        return size <= self.max_object_size
+
+    def add(self,
+            s3_key: str,
+            file_content: bytes,
+            content_type: str = 'application/octet-stream',
+            metadata: Optional[Dict[str, str]] = None) -> Future:
+        """Encola un objeto pequeño. El Future se resuelve con la clave del bundle al escribirlo."""
+        if not self.accepts(len(file_content)):
+            raise ValueError(f"Object too large for packing: {len(file_content)} bytes")
+
+        future: Future = Future()
+        item = {
+            'key': s3_key,
+            'data': file_content,
+            'content_type': content_type,
+            'metadata': metadata or {},
+            'future': future
+        }
+        with self._lock:
+            self._pending.append(item)
+            self._inflight[s3_key] = item
+            self._pending_bytes += len(file_content)
+
+            if self._pending_bytes >= self.max_bundle_size:
+                self._schedule_flush(0)
+            elif self._timer is None:
+                self._schedule_flush(self.flush_interval)
+        return future
+
+    def _schedule_flush(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self) -> Optional[str]:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch = self._pending
+            self._pending = []
+            self._pending_bytes = 0
+
+        if not batch:
+            return None
+
+        with self._lock:
+            # Lo escrito tras un borrado debe quedar por encima de su tombstone
+            written_at = max(
+                [int(time.time() * 1000)]
+                + [self._deleted_at(item['key']) + 1 for item in batch]
+            )
+        bundle_key = self._new_bundle_key(written_at)
+        entries = [
+            {
+                'key': item['key'],
+                'data': item['data'],
+                'content_type': item['content_type'],
+                'metadata': item['metadata'],
+                'written_at': written_at
+            }
+            for item in batch
+        ]
+
+        try:
+            index = self._write_bundle(bundle_key, entries)
+        except Exception as e:
+            logger.error(f"Bundle flush error: {e}")
+            with self._lock:
+                self._release(batch)
+            for item in batch:
+                item['future'].set_exception(e)
+            return None
+
+        with self._lock:
+            self._bundles[bundle_key] = index
+            for entry in index.values():
+                self._promote(entry)
+            self._release(batch)
+
+        logger.info(f"Bundle written: {bundle_key} ({len(batch)} objects)")
+        for item in batch:
+            item['future'].set_result(bundle_key)
+        return bundle_key
+
+    def _release(self, batch: List[Dict[str, Any]]):
+        for item in batch:
+            if self._inflight.get(item['key']) is item:
+                del self._inflight[item['key']]
+
+    def get(self, s3_key: str) -> Tuple[bytes, Dict[str, Any]]:
+        """Devuelve (contenido, entrada) leyendo solo el rango del objeto dentro de su bundle."""
+        with self._lock:
+            item = self._inflight.get(s3_key)
+        if item is not None:
+            return item['data'], {
+                'key': s3_key,
+                'length': len(item['data']),
+                'content_type': item['content_type'],
+                'metadata': item['metadata']
+            }
+
+        entry = self._lookup(s3_key)
+        try:
+            data = self._read_entry(entry)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            # Otro proceso pudo haber compactado el bundle
+            self.refresh(force=True)
+            entry = self._lookup(s3_key, refresh=False)
+            data = self._read_entry(entry)
+        return data, entry
+
+    def delete(self, s3_key: str, refresh: bool = True) -> bool:
+        """Borra la clave; con refresh=False solo se consulta el catalogo local, sin listar S3."""
+        with self._lock:
+            item = self._inflight.get(s3_key)
+        if item is not None:
+            # El lote puede estar en el buffer o ya en manos de otro hilo: esperar a su escritura
+            self.flush()
+            try:
+                item['future'].result()
+            except Exception:
+                pass
+
+        try:
+            entry = self._lookup(s3_key, refresh=refresh)
+        except BundleEntryNotFound:
+            return False
+
+        # El tombstone va por clave e instante, asi sobrevive a compactaciones de cualquier proceso
+        deleted_at = max(int(time.time() * 1000), entry['written_at'])
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=self._tombstone_key(s3_key, deleted_at),
+            Body=b''
+        )
+        with self._lock:
+            self._tombstones.setdefault(s3_key, set()).add(deleted_at)
+            current = self._catalog.get(s3_key)
+            if current is not None and self._is_deleted(current):
+                del self._catalog[s3_key]
+        return True
+
+    def list_entries(self, prefix: str = '') -> List[Dict[str, Any]]:
+        self.refresh()
+        with self._lock:
+            return [
+                entry for key, entry in sorted(self._catalog.items())
+                if key.startswith(prefix)
+            ]
+
+    def refresh(self, force: bool = False):
+        """Sincroniza el catalogo local con los bundles y tombstones presentes en S3."""
+        now = time.monotonic()
+        if not force and now - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = now
+
+        with self._lock:
+            known = set(self._bundles)
+
+        bundle_keys, tombstones = self._list_prefix()
+
+        loaded = {}
+        for bundle_key in bundle_keys - known - self._invalid_bundles:
+            try:
+                loaded[bundle_key] = self._read_index(bundle_key)
+            except ClientError as e:
+                logger.error(f"Bundle index read error ({bundle_key}): {e}")
+            except (ValueError, KeyError, TypeError, struct.error) as e:
+                logger.error(f"Skipping malformed bundle ({bundle_key}): {e}")
+                self._invalid_bundles.add(bundle_key)
+
+        with self._lock:
+            for bundle_key in known - bundle_keys:
+                self._bundles.pop(bundle_key, None)
+            self._bundles.update(loaded)
+            # Conserva los borrados locales que el listado aun no incluia
+            for s3_key, times in self._tombstones.items():
+                tombstones.setdefault(s3_key, set()).update(times)
+            self._tombstones = tombstones
+            self._rebuild_catalog()
+
+    def compact(self, min_live_ratio: float = 0.5) -> Dict[str, Any]:
+        """Reescribe los bundles cuyo espacio vivo esta por debajo de min_live_ratio."""
+        self.refresh(force=True)
+        stats = {'bundles_compacted': 0, 'bundles_removed': 0, 'bytes_reclaimed': 0}
+
+        with self._compact_lock:
+            with self._lock:
+                candidates = []
+                for bundle_key, index in self._bundles.items():
+                    total = sum(e['length'] for e in index.values())
+                    live = [e for e in index.values() if self._catalog.get(e['key']) is e]
+                    live_bytes = sum(e['length'] for e in live)
+                    # Un bundle sin entradas vivas se elimina aunque solo contenga archivos vacios
+                    if not live or (total and live_bytes / total < min_live_ratio):
+                        candidates.append((bundle_key, live, total - live_bytes))
+
+            for bundle_key, live, reclaimed in candidates:
+                new_index = None
+                if live:
+                    body = self.s3_client.get_object(
+                        Bucket=self.bucket_name, Key=bundle_key
+                    )['Body'].read()
+                    entries = [
+                        {
+                            'key': e['key'],
+                            'data': body[e['offset']:e['offset'] + e['length']],
+                            'content_type': e['content_type'],
+                            'metadata': e['metadata'],
+                            'written_at': e['written_at']
+                        }
+                        for e in live
+                    ]
+                    new_key = self._new_bundle_key(int(time.time() * 1000))
+                    new_index = self._write_bundle(new_key, entries)
+
+                self.s3_client.delete_object(Bucket=self.bucket_name, Key=bundle_key)
+
+                with self._lock:
+                    self._bundles.pop(bundle_key, None)
+                    if new_index is not None:
+                        self._bundles[new_key] = new_index
+                    self._rebuild_catalog()
+
+                if new_index is None:
+                    stats['bundles_removed'] += 1
+                else:
+                    stats['bundles_compacted'] += 1
+                stats['bytes_reclaimed'] += reclaimed
+                logger.info(f"Bundle compacted: {bundle_key} ({reclaimed} bytes reclaimed)")
+
+            stats['tombstones_removed'] = self._purge_tombstones()
+        return stats
+
+    def _purge_tombstones(self) -> int:
+        """Elimina los tombstones que ya no ocultan ninguna copia en los bundles existentes."""
+        # Un listado nuevo recoge bundles escritos por otros procesos durante la compactacion
+        self.refresh(force=True)
+        with self._lock:
+            oldest: Dict[str, int] = {}
+            for index in self._bundles.values():
+                for entry in index.values():
+                    current = oldest.get(entry['key'])
+                    if current is None or entry['written_at'] < current:
+                        oldest[entry['key']] = entry['written_at']
+            orphans = [
+                (s3_key, deleted_at)
+                for s3_key, times in self._tombstones.items()
+                for deleted_at in times
+                if s3_key not in oldest or oldest[s3_key] > deleted_at
+            ]
+
+        for s3_key, deleted_at in orphans:
+            self.s3_client.delete_object(
+                Bucket=self.bucket_name,
+                Key=self._tombstone_key(s3_key, deleted_at)
+            )
+        with self._lock:
+            for s3_key, deleted_at in orphans:
+                times = self._tombstones.get(s3_key)
+                if times is not None:
+                    times.discard(deleted_at)
+                    if not times:
+                        del self._tombstones[s3_key]
+        return len(orphans)
+
+    def close(self):
+        self.flush()
+
+    def _lookup(self, s3_key: str, refresh: bool = True) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._catalog.get(s3_key)
+        if entry is None and refresh:
+            self.refresh()
+            with self._lock:
+                entry = self._catalog.get(s3_key)
+        if entry is None:
+            raise BundleEntryNotFound(s3_key)
+        return entry
+
+    def _list_prefix(self) -> Tuple[set, Dict[str, set]]:
+        bundle_keys = set()
+        tombstones: Dict[str, set] = {}
+        tombstone_prefix = self.prefix + TOMBSTONE_DIR
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                if key.startswith(tombstone_prefix):
+                    deleted_at, _, entry_key = key[len(tombstone_prefix):].partition('/')
+                    if not deleted_at.isdigit() or not entry_key:
+                        logger.error(f"Skipping malformed tombstone: {key}")
+                        continue
+                    tombstones.setdefault(entry_key, set()).add(int(deleted_at))
+                elif key.endswith(BUNDLE_SUFFIX):
+                    bundle_keys.add(key)
+        return bundle_keys, tombstones
+
+    def _read_entry(self, entry: Dict[str, Any]) -> bytes:
+        # Un rango vacio (bytes=N-(N-1)) es invalido y S3 devolveria el bundle completo
+        if entry['length'] == 0:
+            return b''
+        start = entry['offset']
+        end = start + entry['length'] - 1
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=entry['bundle_key'],
+            Range=f"bytes={start}-{end}"
+        )
+        data = response['Body'].read()
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise ValueError(f"Checksum mismatch for packed object: {entry['key']}")
+        return data
+
+    def _read_index(self, bundle_key: str) -> Dict[str, Dict[str, Any]]:
+        tail = self.s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=bundle_key,
+            Range=f"bytes=-{INDEX_TAIL_READ}"
+        )['Body'].read()
+
+        if len(tail) < FOOTER_SIZE:
+            raise ValueError(f"Invalid bundle footer: {bundle_key}")
+        magic, index_length = tail[-FOOTER_SIZE:-8], struct.unpack('>Q', tail[-8:])[0]
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f"Invalid bundle footer: {bundle_key}")
+
+        if index_length + FOOTER_SIZE <= len(tail):
+            raw_index = tail[-(index_length + FOOTER_SIZE):-FOOTER_SIZE]
+        else:
+            raw_index = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=bundle_key,
+                Range=f"bytes=-{index_length + FOOTER_SIZE}"
+            )['Body'].read()[:index_length]
+
+        index = json.loads(raw_index.decode('utf-8'))
+        entries = {}
+        for entry in index['entries']:
+            entry['bundle_key'] = bundle_key
+            entries[entry['key']] = entry
+        return entries
+
+    def _write_bundle(self, bundle_key: str, entries: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        # Si una clave aparece varias veces en el lote, solo se conserva la ultima version
+        latest = {}
+        for entry in entries:
+            latest[entry['key']] = entry
+
+        chunks = []
+        index_entries = []
+        offset = 0
+        for entry in latest.values():
+            data = entry['data']
+            chunks.append(data)
+            index_entries.append({
+                'key': entry['key'],
+                'offset': offset,
+                'length': len(data),
+                'sha256': hashlib.sha256(data).hexdigest(),
+                'content_type': entry['content_type'],
+                'metadata': entry['metadata'],
+                'written_at': entry['written_at']
+            })
+            offset += len(data)
+
+        raw_index = json.dumps({'version': 1, 'entries': index_entries}).encode('utf-8')
+        chunks.append(raw_index)
+        chunks.append(BUNDLE_MAGIC + struct.pack('>Q', len(raw_index)))
+
+        # Bucket Key de S3 reduce las llamadas a KMS en las lecturas por rango posteriores
+        success = self.uploader.upload_file_from_memory(
+            b''.join(chunks),
+            bundle_key,
+            'application/octet-stream',
+            {'bundle-format': 'v1', 'entry-count': str(len(index_entries))},
+            bucket_key_enabled=True
+        )
+        if not success:
+            raise RuntimeError(f"Bundle upload failed: {bundle_key}")
+
+        for entry in index_entries:
+            entry['bundle_key'] = bundle_key
+        return {entry['key']: entry for entry in index_entries}
+
+    def _deleted_at(self, s3_key: str) -> int:
+        return max(self._tombstones.get(s3_key, ()), default=-1)
+
+    def _is_deleted(self, entry: Dict[str, Any]) -> bool:
+        return entry['written_at'] <= self._deleted_at(entry['key'])
+
+    def _promote(self, entry: Dict[str, Any]):
+        if self._is_deleted(entry):
+            return
+        current = self._catalog.get(entry['key'])
+        if current is None or self._order(entry) > self._order(current):
+            self._catalog[entry['key']] = entry
+
+    def _rebuild_catalog(self):
+        newest: Dict[str, Dict[str, Any]] = {}
+        for index in self._bundles.values():
+            for entry in index.values():
+                current = newest.get(entry['key'])
+                if current is None or self._order(entry) > self._order(current):
+                    newest[entry['key']] = entry
+
+        # Un tombstone oculta todas las copias anteriores, asi que no resucita versiones antiguas
+        self._catalog = {
+            key: entry for key, entry in newest.items()
+            if not self._is_deleted(entry)
+        }
+
+    @staticmethod
+    def _order(entry: Dict[str, Any]) -> Tuple[int, str]:
+        return entry['written_at'], entry['bundle_key']
+
+    def _new_bundle_key(self, written_at: int) -> str:
+        return f"{self.prefix}{written_at:013d}-{uuid.uuid4().hex[:8]}{BUNDLE_SUFFIX}"
+
+    def _tombstone_key(self, s3_key: str, deleted_at: int) -> str:
+        return f"{self.prefix}{TOMBSTONE_DIR}{deleted_at:013d}/{s3_key}"
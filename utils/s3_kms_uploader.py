@@ -44,7 +44,8 @@ class S3KMSUploader:
                                file_content: bytes,
                                s3_key: str,
                                content_type: str = 'application/octet-stream',
-                               metadata: Optional[Dict[str, str]] = None) -> bool:
+                               metadata: Optional[Dict[str, str]] = None,
+                               bucket_key_enabled: bool = False) -> bool:
         upload_args = {
             'ServerSideEncryption': 'aws:kms',
             'SSEKMSKeyId': self.kms_key_id,
@@ -54,6 +55,9 @@ class S3KMSUploader:
         if metadata:
             upload_args['Metadata'] = metadata
         
+        if bucket_key_enabled:
+            upload_args['BucketKeyEnabled'] = True
+        
         try:
             self.s3_client.put_object(
                 Bucket=self.bucket_name,